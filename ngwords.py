@@ -0,0 +1,77 @@
+"""
+NGワードのクエリ組み立て・照合ヘルパー (Streamlit 非依存、単体テスト可能)
+"""
+import re
+import functools
+from typing import List, Dict, Tuple
+
+
+def normalize_words(raw: str) -> List[str]:
+    if not raw:
+        return []
+    s = raw.replace(",", " ").replace("　", " ")
+    return [w.strip() for w in s.split() if w.strip()]
+
+_QUERY_BREAKING_RE = re.compile(r'["()]')
+
+def invalid_words(words: List[str]) -> List[str]:
+    """Words whose characters break the OR-joined query syntax (the API would answer 400)."""
+    return [w for w in words if _QUERY_BREAKING_RE.search(w)]
+
+def quote_if_space(w: str) -> str:
+    return f'"{w}"' if any(c.isspace() for c in w) else w
+
+def overlong_words(words: List[str], max_len: int = 480) -> List[str]:
+    """Words that cannot fit in any chunk of pack_words(words, max_len)."""
+    return [w for w in words if len(quote_if_space(w)) > max_len]
+
+def pack_words(words: List[str], max_len: int = 480) -> List[List[str]]:
+    """
+    Group words so each OR-joined query stays under max_len (API limit is 512 incl. operators).
+    A word longer than max_len on its own still gets a (too long) chunk; filter with overlong_words first.
+    """
+    chunks, cur, cur_len = [], [], 0
+    for w in words:
+        n = len(quote_if_space(w))
+        if cur and cur_len + 4 + n > max_len:
+            chunks.append(cur)
+            cur, cur_len = [], 0
+        cur_len += n if not cur else 4 + n
+        cur.append(w)
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+@functools.lru_cache(maxsize=32)
+def compile_matcher(words: Tuple[str, ...]) -> Tuple["re.Pattern[str]", List[List[str]]]:
+    """
+    Compile NG words into one case-insensitive regex so each text is scanned once.
+    Each key gets its own capture group inside a lookahead, tried longest first, so a match reports
+    the longest word starting at each position via m.lastindex; credits[m.lastindex - 1] lists every
+    word that key contains (covers words sharing a prefix).
+    """
+    keys = sorted({w.lower() for w in words}, key=len, reverse=True)
+    pat = re.compile("(?=(?:" + "|".join(f"({re.escape(k)})" for k in keys) + "))", re.IGNORECASE)
+    by_key: Dict[str, List[str]] = {}
+    for w in words:
+        by_key.setdefault(w.lower(), []).append(w)
+    credits = [[w for sub in keys if sub in k for w in by_key[sub]] for k in keys]
+    return pat, credits
+
+def match_words(words: List[str], text: str) -> set:
+    """NG words contained in text."""
+    if not words:
+        return set()
+    pat, credits = compile_matcher(tuple(words))
+    found = set()
+    for m in pat.finditer(text):
+        found.update(credits[m.lastindex - 1])
+    return found
+
+def count_word_hits(words: List[str], tweets: List[dict]) -> Dict[str, int]:
+    """Dispatch tweets of an OR-joined search back to each word; returns unique authors per word."""
+    authors = {w: set() for w in words}
+    for t in tweets:
+        for w in match_words(words, t.get("text", "")):
+            authors[w].add(t["author_id"])
+    return {w: len(a) for w, a in authors.items()}
@@ -0,0 +1,58 @@
+"""
+APIレート制御用トークンバケット (Streamlit 非依存、単体テスト可能)
+"""
+import threading
+import time
+from typing import Callable, Optional
+
+
+class TokenBucket:
+    """
+    Paces calls to rate_per_sec with bursts up to burst.
+    Each 429 halves the rate (floor base/16); the full rate returns once restore_after seconds pass
+    without another 429 (the API's 15-minute window). acquire() reserves a token under the lock and
+    sleeps outside it; when the wait would exceed max_wait it reserves nothing and returns False,
+    so callers can report a rate-limit error instead of blocking the script thread.
+    """
+
+    def __init__(self, rate_per_sec: float, burst: int, restore_after: float = 900.0, max_wait: float = 5.0,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.base_rate = self.rate = rate_per_sec
+        self.burst = burst
+        self.tokens = float(burst)
+        self.restore_after = restore_after
+        self.max_wait = max_wait
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._restore_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        if self._restore_at is not None and now >= self._restore_at:
+            # Throttled rate up to the restore point, base rate after it
+            self.tokens = min(self.burst, self.tokens + max(0.0, self._restore_at - self._updated) * self.rate)
+            self._updated = max(self._updated, self._restore_at)
+            self.rate = self.base_rate
+            self._restore_at = None
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> bool:
+        with self._lock:
+            self._refill()
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if wait > self.max_wait:
+                return False
+            self.tokens -= 1  # reserved; later callers see the debt and wait longer
+        if wait:
+            self._sleep(wait)
+        return True
+
+    def on_429(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(self.base_rate / 16, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            self._restore_at = self._clock() + self.restore_after
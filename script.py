@@ -5,19 +5,32 @@ NGワード抽出ツール 3.0 (Streamlit)
 - Save as app.py. Requires .env with TNSS_BEARER_TOKEN=<X/Twitter Bearer Token>
 """
 import os
+import hashlib
+import logging
 import time
 import json
 import io
+import queue
+import socket
 import threading
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional, Tuple
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 import pandas as pd
 import streamlit as st
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
+from ngwords import normalize_words, invalid_words, overlong_words, quote_if_space, pack_words, count_word_hits
+from ratelimit import TokenBucket
+
 # -------------------------
 # CONFIG
 # -------------------------
@@ -29,21 +42,24 @@ st.markdown(
     unsafe_allow_html=True
 )
 
-load_dotenv()
-BEARER = os.getenv("EXTNSS_BEARER_TOKEN")  # required
-
 SEARCH_URL = "https://api.twitter.com/2/tweets/search/recent"
 USERS_URL = "https://api.twitter.com/2/users"
-HEADERS = {"Authorization": f"Bearer {BEARER}"} if BEARER else {}
+MAX_QUERY_LEN = 512  # recent-search query limit
+MAX_QUERY_CHUNKS = 10  # interactive search: at most this many chunked requests per click
 
 DB_FILE = "ng_tool3.db"
 
+logger = logging.getLogger(__name__)
+
 # -------------------------
 # DB (SQLite) helpers
 # -------------------------
 def init_db():
     con = sqlite3.connect(DB_FILE, check_same_thread=False)
     cur = con.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
     cur.execute("""CREATE TABLE IF NOT EXISTS search_history (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     query TEXT,
@@ -57,6 +73,20 @@ def init_db():
                     content TEXT,
                     created_at TEXT
                    )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS search_cursors (
+                    query TEXT PRIMARY KEY,
+                    since_id TEXT
+                   )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    body BLOB,
+                    ts INTEGER
+                   )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS user_cache (
+                    id TEXT PRIMARY KEY,
+                    body BLOB,
+                    ts INTEGER
+                   )""")
     cur.execute("""CREATE TABLE IF NOT EXISTS logs (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     level TEXT,
@@ -66,161 +96,457 @@ def init_db():
     con.commit()
     con.close()
 
+_tls = threading.local()
+
+def _conn() -> sqlite3.Connection:
+    """Per-thread persistent connection (autocommit); avoids connect/close on every call."""
+    c = getattr(_tls, "c", None)
+    if c is None:
+        c = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        c.execute("PRAGMA temp_store=MEMORY")
+        _tls.c = c
+    return c
+
+# Log/history inserts are queued and written in bulk by a single writer thread
+WRITE_BATCH_SIZE = 100
+WRITE_FLUSH_SECONDS = 0.5
+_WRITE_SQL = {
+    "history": "INSERT INTO search_history(query, created_at, hit_count) VALUES (?, ?, ?)",
+    "log": "INSERT INTO logs(level, message, created_at) VALUES (?, ?, ?)",
+    "user": "INSERT OR REPLACE INTO user_cache(id, body, ts) VALUES (?, ?, ?)",
+}
+
+def _write_batch(batch: List[Tuple[str, tuple]]):
+    groups: Dict[str, List[tuple]] = {}
+    for kind, row in batch:
+        groups.setdefault(kind, []).append(row)
+    c = _conn()
+    c.execute("BEGIN")
+    try:
+        for kind, rows in groups.items():
+            c.executemany(_WRITE_SQL[kind], rows)
+        c.execute("COMMIT")
+    except Exception:
+        if c.in_transaction:
+            c.execute("ROLLBACK")
+        raise
+
+def _write_with_fallback(batch: List[Tuple[str, tuple]]):
+    """Write batch in one transaction; if it fails, retry row by row so one bad row only drops itself."""
+    try:
+        _write_batch(batch)
+        return
+    except Exception as e:  # sqlite3.Error, but also binding errors such as OverflowError
+        logger.warning("batched write of %d rows failed (%s); retrying row by row", len(batch), e)
+    c = _conn()
+    for kind, row in batch:
+        try:
+            c.execute(_WRITE_SQL[kind], row)
+        except Exception:
+            logger.exception("dropped %s row (%r)", kind, row[0])
+
+def _writer_loop(q: queue.SimpleQueue):
+    while True:
+        batch = [q.get()]
+        deadline = time.time() + WRITE_FLUSH_SECONDS
+        while len(batch) < WRITE_BATCH_SIZE:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            _write_with_fallback(batch)
+        except Exception:
+            # Never let the daemon writer die; queued logs/history would otherwise pile up unwritten
+            logger.exception("db writer failed on a batch of %d rows", len(batch))
+
+@st.cache_resource
+def _start_writer() -> queue.SimpleQueue:
+    """One queue + writer thread per process (Streamlit re-executes the script on every rerun)."""
+    q = queue.SimpleQueue()
+    threading.Thread(target=_writer_loop, args=(q,), daemon=True).start()
+    return q
+
+def db_flush():
+    """Write whatever is still queued, so reads on this rerun see it."""
+    batch = []
+    while True:
+        try:
+            batch.append(_write_queue.get_nowait())
+        except queue.Empty:
+            break
+    if batch:
+        _write_with_fallback(batch)
+
 def db_insert_history(query: str, hit_count: int):
-    con = sqlite3.connect(DB_FILE, check_same_thread=False)
-    cur = con.cursor()
-    cur.execute("INSERT INTO search_history(query, created_at, hit_count) VALUES (?, ?, ?)",
-                (query, datetime.utcnow().isoformat(), hit_count))
-    con.commit(); con.close()
+    _write_queue.put(("history", (query, datetime.utcnow().isoformat(), hit_count)))
 
 def db_get_history(limit=20):
-    con = sqlite3.connect(DB_FILE, check_same_thread=False)
-    cur = con.cursor()
-    cur.execute("SELECT query, created_at, hit_count FROM search_history ORDER BY id DESC LIMIT ?", (limit,))
-    rows = cur.fetchall(); con.close()
-    return rows
+    db_flush()
+    cur = _conn().execute("SELECT query, created_at, hit_count FROM search_history ORDER BY id DESC LIMIT ?", (limit,))
+    return cur.fetchall()
 
 def db_add_list(name: str, type_: str, content: str):
-    con = sqlite3.connect(DB_FILE, check_same_thread=False)
-    cur = con.cursor()
-    cur.execute("INSERT INTO lists(name, type, content, created_at) VALUES (?, ?, ?, ?)",
-                (name, type_, content, datetime.utcnow().isoformat()))
-    con.commit(); con.close()
+    _conn().execute("INSERT INTO lists(name, type, content, created_at) VALUES (?, ?, ?, ?)",
+                    (name, type_, content, datetime.utcnow().isoformat()))
 
 def db_get_lists(type_: Optional[str]=None):
-    con = sqlite3.connect(DB_FILE, check_same_thread=False)
-    cur = con.cursor()
     if type_:
-        cur.execute("SELECT id, name, content FROM lists WHERE type=? ORDER BY id DESC", (type_,))
+        cur = _conn().execute("SELECT id, name, content FROM lists WHERE type=? ORDER BY id DESC", (type_,))
     else:
-        cur.execute("SELECT id, name, type, content FROM lists ORDER BY id DESC")
-    rows = cur.fetchall(); con.close()
-    return rows
+        cur = _conn().execute("SELECT id, name, type, content FROM lists ORDER BY id DESC")
+    return cur.fetchall()
 
 def db_log(level: str, message: str):
-    con = sqlite3.connect(DB_FILE, check_same_thread=False)
-    cur = con.cursor()
-    cur.execute("INSERT INTO logs(level, message, created_at) VALUES (?, ?, ?)",
-                (level, message, datetime.utcnow().isoformat()))
-    con.commit(); con.close()
+    _write_queue.put(("log", (level, message, datetime.utcnow().isoformat())))
 
 def db_get_logs(limit=100):
-    con = sqlite3.connect(DB_FILE, check_same_thread=False)
-    cur = con.cursor()
-    cur.execute("SELECT level, message, created_at FROM logs ORDER BY id DESC LIMIT ?", (limit,))
-    rows = cur.fetchall(); con.close()
-    return rows
-
-init_db()
+    db_flush()
+    cur = _conn().execute("SELECT level, message, created_at FROM logs ORDER BY id DESC LIMIT ?", (limit,))
+    return cur.fetchall()
+
+def db_get_cursor(query: str) -> Optional[str]:
+    row = _conn().execute("SELECT since_id FROM search_cursors WHERE query=?", (query,)).fetchone()
+    return row[0] if row else None
+
+def db_set_cursor(query: str, since_id: str):
+    _conn().execute("""INSERT INTO search_cursors(query, since_id) VALUES (?, ?)
+                       ON CONFLICT(query) DO UPDATE SET since_id=excluded.since_id""", (query, since_id))
+
+def db_clear_cursor(query: str):
+    _conn().execute("DELETE FROM search_cursors WHERE query=?", (query,))
+
+def db_cache_get(key: str, max_age: Optional[int]) -> Optional[dict]:
+    row = _conn().execute("SELECT body, ts FROM response_cache WHERE key=?", (key,)).fetchone()
+    if row is None or (max_age is not None and time.time() - row[1] >= max_age):
+        return None
+    return orjson.loads(row[0])
+
+def db_cache_put(key: str, body: dict, retention: int):
+    """Store body under key and prune entries older than retention seconds."""
+    now = int(time.time())
+    c = _conn()
+    c.execute("DELETE FROM response_cache WHERE ts < ?", (now - retention,))
+    c.execute("INSERT OR REPLACE INTO response_cache(key, body, ts) VALUES (?, ?, ?)", (key, orjson.dumps(body), now))
+
+def db_get_users(ids: List[str], max_age: Optional[int]) -> Dict[str, dict]:
+    found = {}
+    now = time.time()
+    for i in range(0, len(ids), 500):  # stay under SQLite's bound-parameter limit
+        part = ids[i:i + 500]
+        cur = _conn().execute(f"SELECT id, body, ts FROM user_cache WHERE id IN ({','.join('?' * len(part))})", part)
+        for uid, body, ts in cur:
+            if max_age is None or now - ts < max_age:
+                found[uid] = orjson.loads(body)
+    return found
+
+def db_put_users(users: Dict[str, dict], retention: Optional[int]):
+    """Queue users for user_cache and prune rows older than retention seconds (None keeps everything)."""
+    ts = int(time.time())
+    if retention is not None:
+        _conn().execute("DELETE FROM user_cache WHERE ts < ?", (ts - retention,))
+    for uid, u in users.items():
+        _write_queue.put(("user", (uid, orjson.dumps(u), ts)))
+
+@st.cache_resource
+def _bootstrap():
+    """Parse .env and create tables once per process, not on every rerun."""
+    load_dotenv()
+    init_db()
+    return True
+
+_bootstrap()
+_write_queue = _start_writer()
 
 # -------------------------
 # Utilities
 # -------------------------
-def normalize_words(raw: str) -> List[str]:
-    if not raw:
-        return []
-    s = raw.replace(",", " ").replace("　", " ")
-    return [w.strip() for w in s.split() if w.strip()]
-
-def quote_if_space(w: str) -> str:
-    return f'"{w}"' if any(c.isspace() for c in w) else w
-
 def timestamp_to_iso(dt: datetime) -> str:
     return dt.isoformat("T") + "Z"
 
 # -------------------------
-# API calls (with basic rate handling)
+# API calls (token-bucket rate limiting)
 # -------------------------
-RATE_COOLDOWN_SECONDS = 60
-_last_429_time = None
+BEARER = os.getenv("EXTNSS_BEARER_TOKEN")  # required
 
-def handle_429():
-    global _last_429_time
-    _last_429_time = time.time()
-    db_log("WARN", "429 received, entering cooldown")
-    return
+# Probe after 60 s idle, every 30 s, give up after 3 misses (Linux default idle time is 2 h)
+_KEEPALIVE_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)] + [
+    (socket.IPPROTO_TCP, getattr(socket, name), value)
+    for name, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 30), ("TCP_KEEPCNT", 3))
+    if hasattr(socket, name)
+]
 
-def is_in_cooldown() -> bool:
-    if _last_429_time is None:
-        return False
-    return (time.time() - _last_429_time) < RATE_COOLDOWN_SECONDS
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose pooled sockets send TCP keepalive probes while idle. This keeps NAT/firewall
+    state for pooled connections and detects dead peers early; a connection the server closes is
+    still dropped, and urllib3 simply reconnects on the next request.
+    """
 
-@st.cache_data(ttl=300, show_spinner=False)
-def call_search_api(params: dict) -> Dict[str, Any]:
-    """Direct call, cached"""
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + _KEEPALIVE_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+@st.cache_resource
+def _http_session() -> requests.Session:
+    """Shared keep-alive pool for api.twitter.com (no TLS handshake per call), once per process."""
+    s = requests.Session()
+    # Transient throttling/5xx self-heal (honouring Retry-After); if retries run out the last
+    # response is returned as-is so a final 429 still reaches handle_429 and the token bucket.
+    retry = Retry(total=3, backoff_factor=1.5, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET",), respect_retry_after_header=True, raise_on_status=False)
+    s.mount("https://", KeepAliveAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+    if BEARER:
+        s.headers["Authorization"] = f"Bearer {BEARER}"
+    # requests' default Accept-Encoding already offers br when Brotli is installed (see requirements)
+    return s
+
+_session = _http_session()
+
+# Persistent response cache (survives restarts / shared by workers). Replay mode serves only
+# from it, ignoring age, and never touches the network: TNSS_REPLAY=1 for demos/testing.
+RESPONSE_CACHE_TTL = 300                     # freshness: normal mode reuses entries younger than this
+RESPONSE_CACHE_RETENTION = 30 * 24 * 3600    # storage: kept this long so replay recordings survive
+REPLAY_MODE = os.getenv("TNSS_REPLAY") == "1"
+
+@st.cache_resource
+def _rate_buckets() -> Dict[str, TokenBucket]:
+    """Buckets live once per process so pacing survives reruns and is shared with the scheduler."""
+    return {"search": TokenBucket(1.0, 5), "users": TokenBucket(3.0, 10)}
+
+_search_bucket = _rate_buckets()["search"]
+_users_bucket = _rate_buckets()["users"]
+
+API_WORKERS = 4
+
+@st.cache_resource
+def _api_executor() -> ThreadPoolExecutor:
+    """One pool per process, so worker threads (and their thread-local SQLite connections) are reused."""
+    return ThreadPoolExecutor(max_workers=API_WORKERS, thread_name_prefix="api")
+
+def _parallel_map(fn, items: list) -> list:
+    """Run independent API calls concurrently; the token buckets, not this pool, enforce pacing."""
+    if len(items) <= 1:
+        return [fn(x) for x in items]
+    return list(_api_executor().map(fn, items))
+
+def handle_429(bucket: TokenBucket, endpoint: str):
+    bucket.on_429()
+    db_log("WARN", f"429 received on {endpoint}, rate lowered to {bucket.rate:.2f}/s")
+
+def _response_key(url: str, params: dict) -> str:
+    return hashlib.sha256(orjson.dumps({"url": url, "params": params}, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def _cached_response(url: str, params: dict) -> Optional[dict]:
+    return db_cache_get(_response_key(url, params), None if REPLAY_MODE else RESPONSE_CACHE_TTL)
+
+def _store_response(url: str, params: dict, resp: dict):
+    if not resp.get("error"):
+        db_cache_put(_response_key(url, params), resp, RESPONSE_CACHE_RETENTION)
+
+class ApiError(Exception):
+    """Carries an error response out of a cached function so st.cache_data does not memoize it."""
+
+    def __init__(self, resp: Dict[str, Any]):
+        super().__init__(resp.get("error"))
+        self.resp = resp
+
+def _fetch_search_uncached(params: dict) -> Dict[str, Any]:
+    if REPLAY_MODE:
+        return {"error": "replay mode: キャッシュにありません"}
     if not BEARER:
         return {"error": "API token not set"}
+    if not _search_bucket.acquire():
+        db_log("WARN", "search rate limited locally; skipping call")
+        return {"error": "429"}
     try:
-        r = requests.get(SEARCH_URL, headers=HEADERS, params=params, timeout=25)
+        r = _session.get(SEARCH_URL, params=params, timeout=25)
     except Exception as e:
         db_log("ERROR", f"search request exception: {e}")
         return {"error": f"通信エラー: {e}"}
     if r.status_code == 429:
-        handle_429()
+        handle_429(_search_bucket, "search")
         return {"error": "429"}
     if r.status_code != 200:
         db_log("ERROR", f"search returned {r.status_code} {r.text}")
         return {"error": f"{r.status_code} {r.text}"}
-    return r.json()
+    return orjson.loads(r.content)
 
 @st.cache_data(ttl=300, show_spinner=False)
-def call_users_api(ids: List[str]) -> Dict[str, Any]:
-    if not BEARER:
-        return {"error": "API token not set"}
-    if not ids:
-        return {"data": []}
-    params = {"ids": ",".join(ids), "user.fields": "username,name,profile_image_url,public_metrics,verified,created_at"}
+def _call_search_cached(params: dict) -> Dict[str, Any]:
+    hit = _cached_response(SEARCH_URL, params)
+    if hit is not None:
+        return hit
+    resp = _fetch_search_uncached(params)
+    if resp.get("error"):
+        raise ApiError(resp)
+    _store_response(SEARCH_URL, params, resp)
+    return resp
+
+def call_search_api(params: dict) -> Dict[str, Any]:
+    """Direct call, cached (in-process, then response_cache); only successes are cached"""
+    try:
+        return _call_search_cached(params)
+    except ApiError as e:
+        return e.resp
+
+def merge_search_responses(resps: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combine chunked search responses: tweets deduped by id, includes.users by user id."""
+    tweets, users = {}, {}
+    for resp in resps:
+        if resp.get("error"):
+            return resp
+        for t in resp.get("data", []):
+            tweets.setdefault(t["id"], t)
+        for u in resp.get("includes", {}).get("users", []):
+            users.setdefault(u["id"], u)
+    return {"data": list(tweets.values()), "includes": {"users": list(users.values())}}
+
+USERS_BATCH_SIZE = 100  # /2/users accepts at most 100 ids per call
+USER_CACHE_TTL = 600      # L1: in-process memo
+USER_DISK_TTL = 86400     # L2: user_cache table, survives restarts
+
+@st.cache_resource
+def _user_cache() -> Tuple[TTLCache, threading.Lock]:
+    """Per-user profile memo shared by reruns and the scheduler thread."""
+    return TTLCache(maxsize=4096, ttl=USER_CACHE_TTL), threading.Lock()
+
+USER_FIELDS = "username,name,profile_image_url,public_metrics,verified,created_at"
+
+def _users_params(ids: Tuple[str, ...]) -> dict:
+    return {"ids": ",".join(ids), "user.fields": USER_FIELDS}
+
+def _fetch_users_uncached(ids: Tuple[str, ...]) -> Dict[str, Any]:
+    if REPLAY_MODE:
+        return {"error": "replay mode: キャッシュにありません"}
+    params = _users_params(ids)
+    if not _users_bucket.acquire():
+        db_log("WARN", "users rate limited locally; skipping call")
+        return {"error": "429"}
     try:
-        r = requests.get(USERS_URL, headers=HEADERS, params=params, timeout=25)
+        r = _session.get(USERS_URL, params=params, timeout=25)
     except Exception as e:
         db_log("ERROR", f"users request exception: {e}")
         return {"error": f"通信エラー: {e}"}
     if r.status_code == 429:
-        handle_429()
+        handle_429(_users_bucket, "users")
         return {"error": "429"}
     if r.status_code != 200:
         db_log("ERROR", f"users returned {r.status_code} {r.text}")
         return {"error": f"{r.status_code} {r.text}"}
-    return r.json()
+    return orjson.loads(r.content)
+
+def call_users_api(ids: List[str]) -> Dict[str, Any]:
+    """Lookup users, cached per user id (memory, then user_cache table): only unknown ids hit the API."""
+    if not BEARER and not REPLAY_MODE:
+        return {"error": "API token not set"}
+    if not ids:
+        return {"data": []}
+    cache, lock = _user_cache()
+    with lock:
+        found = {uid: cache[uid] for uid in ids if uid in cache}
+    misses = [uid for uid in ids if uid not in found]
+    if misses:
+        stored = db_get_users(misses, None if REPLAY_MODE else USER_DISK_TTL)
+        with lock:
+            cache.update(stored)
+        found.update(stored)
+        misses = [uid for uid in misses if uid not in stored]
+    batches = [tuple(misses[i:i + USERS_BATCH_SIZE]) for i in range(0, len(misses), USERS_BATCH_SIZE)]
+    for resp in _parallel_map(_fetch_users_uncached, batches):
+        if resp.get("error"):
+            return resp
+        fetched = {u["id"]: u for u in resp.get("data", [])}
+        with lock:
+            cache.update(fetched)
+        db_put_users(fetched, None if REPLAY_MODE else USER_DISK_TTL)
+        found.update(fetched)
+    return {"data": [found[uid] for uid in ids if uid in found]}
+
+def users_for_tweets(resp: Dict[str, Any], author_ids: List[str]) -> Dict[str, Any]:
+    """
+    Users for author_ids, taken from the search response's includes.users (expansions=author_id).
+    Only authors missing there fall back to call_users_api.
+    """
+    included = resp.get("includes", {}).get("users", [])
+    by_id = {u["id"]: u for u in included}
+    if by_id:
+        cache, lock = _user_cache()
+        with lock:
+            cache.update(by_id)
+        db_put_users(by_id, None if REPLAY_MODE else USER_DISK_TTL)
+    missing = [uid for uid in author_ids if uid not in by_id]
+    if missing:
+        extra = call_users_api(missing)
+        if extra.get("error"):
+            return extra
+        by_id.update({u["id"]: u for u in extra.get("data", [])})
+    return {"data": [by_id[uid] for uid in author_ids if uid in by_id]}
 
 # -------------------------
 # Monitoring background job
 # -------------------------
+TWITTER_EPOCH_MS = 1288834974657
+SINCE_ID_MAX_AGE = 7 * 24 * 3600 - 3600  # recent search rejects since_id older than its 7-day window
+
+def snowflake_time(tweet_id: str) -> float:
+    """Creation time (epoch seconds) encoded in a tweet id."""
+    return ((int(tweet_id) >> 22) + TWITTER_EPOCH_MS) / 1000
+
 _scheduler_thread = None
 _scheduler_running = False
 
 def monitor_job_once(ng_words: List[str], max_results: int, filters: dict):
     """
-    Run one cycle: search each ng_word, gather new users, apply filters, save to DB.
+    Run one cycle: search ng_words (OR-joined, one request per chunk, only tweets newer than the
+    stored since_id), gather new users, apply filters, save to DB.
     filters: dict of various filter settings
     """
-    global _last_429_time
-    discovered = []
-    for w in ng_words:
-        query = " OR ".join([quote_if_space(w) for w in [w]])
-        params = {"query": f"{query} -is:retweet", "tweet.fields": "author_id,created_at,text", "max_results": max(10, min(max_results, 100))}
-        if is_in_cooldown():
-            db_log("WARN", "In cooldown; skipping searches")
-            continue
-        resp = call_search_api(params)
+    discovered: Dict[str, dict] = {}
+    chunks = pack_words(ng_words, max_len=480)
+    queries = [" OR ".join(quote_if_space(w) for w in chunk) for chunk in chunks]
+    base = {"tweet.fields": "id,author_id,created_at,text", "expansions": "author_id", "user.fields": USER_FIELDS,
+            "max_results": max(10, min(max_results, 100))}
+    param_list = []
+    for query in queries:
+        params = {**base, "query": f"{query} -is:retweet"}
+        since_id = db_get_cursor(query)
+        if since_id and time.time() - snowflake_time(since_id) >= SINCE_ID_MAX_AGE:
+            db_clear_cursor(query)
+            since_id = None
+        if since_id:
+            params["since_id"] = since_id
+        param_list.append(params)
+    # Uncached: with since_id only new tweets come back, so a cached "no hits" would hide them
+    for chunk, query, resp in zip(chunks, queries, _parallel_map(_fetch_search_uncached, param_list)):
         if resp.get("error"):
             if resp["error"] == "429":
                 st.toast("API制限により監視一時停止（自動再開予定）", icon="⚠️")
                 continue
-            db_log("ERROR", f"search error for {w}: {resp['error']}")
+            db_log("ERROR", f"search error for {query}: {resp['error']}")
+            if resp["error"].startswith("400") and "since_id" in resp["error"]:
+                db_clear_cursor(query)  # next cycle retries without the rejected cursor
             continue
         tweets = resp.get("data", [])
         if not tweets:
-            db_log("INFO", f"{w}: no hits")
-            db_insert_history(query, 0)
+            db_log("INFO", f"{query}: no hits")
+            for w in chunk:
+                db_insert_history(quote_if_space(w), 0)
             continue
-        user_ids = list({t["author_id"] for t in tweets})
-        users_resp = call_users_api(user_ids)
+        user_ids = list(dict.fromkeys(t["author_id"] for t in tweets))
+        users_resp = users_for_tweets(resp, user_ids)
         if users_resp.get("error"):
             db_log("ERROR", f"users error: {users_resp['error']}")
             continue
         users = users_resp.get("data", [])
         for u in users:
+            if u["id"] in discovered:
+                continue
             pm = u.get("public_metrics", {})
             tweet_count = pm.get("tweet_count", 0)
             follower_count = pm.get("followers_count", 0) if pm else None
@@ -233,11 +559,12 @@ def monitor_job_once(ng_words: List[str], max_results: int, filters: dict):
             if filters.get("min_following") and (following_count is None or following_count < filters["min_following"]):
                 ok = False
             if ok:
-                discovered.append(u)
-        db_insert_history(query, len(users))
-    unique = {u["id"]: u for u in discovered}.values()
-    if unique:
-        db_log("INFO", f"monitor discovered {len(unique)}")
+                discovered[u["id"]] = u
+        for w, n in count_word_hits(chunk, tweets).items():
+            db_insert_history(quote_if_space(w), n)
+        db_set_cursor(query, max((t["id"] for t in tweets), key=int))
+    if discovered:
+        db_log("INFO", f"monitor discovered {len(discovered)}")
     return
 
 def start_scheduler(interval_minutes: int, ng_words: List[str], max_results:int, filters: dict):
@@ -264,6 +591,27 @@ def stop_scheduler():
     global _scheduler_running
     _scheduler_running = False
 
+# -------------------------
+# Export builders (cached so reruns skip re-encoding an unchanged result)
+# -------------------------
+EXPORT_CACHE_ENTRIES = 8  # per format; older result sets are evicted
+
+@st.cache_data(show_spinner=False, max_entries=EXPORT_CACHE_ENTRIES)
+def _to_csv(df: pd.DataFrame) -> bytes:
+    return df.to_csv(index=False).encode("utf-8-sig")
+
+@st.cache_data(show_spinner=False, max_entries=EXPORT_CACHE_ENTRIES)
+def _to_xlsx(df: pd.DataFrame) -> bytes:
+    buf = io.BytesIO()
+    # No constant_memory: to_excel writes column by column, and that mode drops writes to flushed rows
+    with pd.ExcelWriter(buf, engine="xlsxwriter", engine_kwargs={"options": {"strings_to_urls": False}}) as writer:
+        df.to_excel(writer, index=False, sheet_name="results")
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=EXPORT_CACHE_ENTRIES)
+def _to_json(df: pd.DataFrame) -> bytes:
+    return df.to_json(orient="records", force_ascii=False).encode("utf-8")
+
 # -------------------------
 # Streamlit UI (Main)
 # -------------------------
@@ -274,26 +622,41 @@ left, right = st.columns([2,3])
 
 with left:
     st.header("検索ビルダー")
-    raw_input = st.text_area("NGワード（スペース / カンマ / 改行で区切り）", placeholder="例: 暴言, 詐欺", height=100)
-    max_results = st.slider("取得件数", 10, 100, 30, step=10)
-    min_followers = st.number_input("最小フォロワー数（0=無制限）", min_value=0, value=0)
-    require_no_posts = st.checkbox("投稿ゼロのみ (tweet_count == 0)")
-    require_default_icon = st.checkbox("アイコン未設定のみ")
-    min_tweet_count = st.number_input("最小ツイート数（0=無制限）", min_value=0, value=0)
-    min_following = st.number_input("最小フォロー数（0=無制限）", min_value=0, value=0)
-    verified_only = st.checkbox("認証済みユーザーのみ", value=False)
-    run_query = st.button("🔍 検索実行（即時）")
+    # Widgets inside the form buffer edits; only the submit button triggers a rerun
+    with st.form("search"):
+        raw_input = st.text_area("NGワード（スペース / カンマ / 改行で区切り）", placeholder="例: 暴言, 詐欺", height=100)
+        max_results = st.slider("取得件数", 10, 100, 30, step=10)
+        min_followers = st.number_input("最小フォロワー数（0=無制限）", min_value=0, value=0)
+        require_no_posts = st.checkbox("投稿ゼロのみ (tweet_count == 0)")
+        require_default_icon = st.checkbox("アイコン未設定のみ")
+        min_tweet_count = st.number_input("最小ツイート数（0=無制限）", min_value=0, value=0)
+        min_following = st.number_input("最小フォロー数（0=無制限）", min_value=0, value=0)
+        verified_only = st.checkbox("認証済みユーザーのみ", value=False)
+        run_query = st.form_submit_button("🔍 検索実行（即時）")
+        # Second submit button so monitoring starts with the words/filters currently in the form
+        start_mon = st.form_submit_button("監視開始 ▶")
 
 with right:
     st.header("操作 / 実行")
     interval = st.number_input("監視間隔（分）", min_value=1, value=15)
-    start_mon = st.button("監視開始 ▶")
+    st.caption("監視は検索ビルダーの「監視開始 ▶」で、入力中の NGワード・フィルタを使って開始します。")
     stop_mon = st.button("監視停止 ⏹")
     if start_mon:
         words = normalize_words(raw_input)
-        filters = {"require_no_posts": require_no_posts, "min_followers": min_followers, "min_following": min_following}
-        start_scheduler(interval, words, max_results, filters)
-        st.success("監視を開始しました。")
+        bad = invalid_words(words)
+        if bad:
+            st.warning(f"使用できない文字（\" ( )）を含むため監視対象から除外: {', '.join(bad)}")
+            words = [w for w in words if w not in bad]
+        too_long = overlong_words(words)
+        if too_long:
+            st.warning(f"長すぎるため監視対象から除外（{len(too_long)} 語）: {', '.join(w[:20] + '…' for w in too_long)}")
+            words = [w for w in words if w not in too_long]
+        if not words:
+            st.warning("監視するNGワードがありません。検索ビルダーに入力してください。")
+        else:
+            filters = {"require_no_posts": require_no_posts, "min_followers": min_followers, "min_following": min_following}
+            start_scheduler(interval, words, max_results, filters)
+            st.success("監視を開始しました。")
     if stop_mon:
         stop_scheduler()
         st.success("監視を停止しました。")
@@ -302,102 +665,112 @@ with right:
     st.header("エクスポート / 管理")
     st.markdown("検索結果はCSV / Excel / JSONでエクスポート可能。履歴やプリセットを管理できます。")
 
-def build_query(raw_input: str) -> Tuple[str, dict]:
+def build_query(raw_input: str) -> Tuple[str, List[dict]]:
+    """OR-joined query for display/history, plus one params dict per chunk that fits the query limit."""
     words = normalize_words(raw_input)
     if not words:
-        return "", {}
+        return "", []
     query = " OR ".join([quote_if_space(w) for w in words])
-    params = {"query": f"{query} -is:retweet", "max_results": max(10, min(max_results, 100)),
-              "tweet.fields": "author_id,created_at,text"}
-    return query, params
+    base = {"max_results": max(10, min(max_results, 100)),
+            "tweet.fields": "author_id,created_at,text", "expansions": "author_id", "user.fields": USER_FIELDS}
+    param_list = [{**base, "query": " OR ".join(quote_if_space(w) for w in chunk) + " -is:retweet"}
+                  for chunk in pack_words(words, max_len=480)]
+    return query, param_list
 
 if run_query:
-    if is_in_cooldown():
-        st.error("APIのレート制限により現在一時的に実行できません。しばらく待ってください。")
+    query, param_list = build_query(raw_input)
+    bad = invalid_words(normalize_words(raw_input))
+    if not query:
+        st.warning("NGワードを入力してください。")
+    elif bad:
+        st.warning(f"使用できない文字（\" ( )）を含むNGワードがあります: {', '.join(bad)}")
+    elif any(len(p["query"]) > MAX_QUERY_LEN for p in param_list):
+        st.warning(f"{MAX_QUERY_LEN} 文字を超えるNGワードがあります。短くしてください。")
+    elif len(param_list) > MAX_QUERY_CHUNKS:
+        st.warning(f"NGワードが多すぎます（検索 {len(param_list)} 回分 / 上限 {MAX_QUERY_CHUNKS} 回）。減らしてください。")
     else:
-        query, params = build_query(raw_input)
-        if not query:
-            st.warning("NGワードを入力してください。")
+        with st.spinner("検索中..."):
+            resp = merge_search_responses(_parallel_map(call_search_api, param_list))
+        if resp.get("error"):
+            st.error(f"検索エラー: {resp['error']}")
         else:
-            with st.spinner("検索中..."):
-                resp = call_search_api(params)
-            if resp.get("error"):
-                st.error(f"検索エラー: {resp['error']}")
+            data = resp.get("data", [])
+            db_insert_history(query, len(data))
+            if not data:
+                st.info("該当するツイートはありませんでした。")
             else:
-                data = resp.get("data", [])
-                db_insert_history(query, len(data))
-                if not data:
-                    st.info("該当するツイートはありませんでした。")
+                first_tweet = {}  # author_id -> first tweet, insertion-ordered
+                for t in data:
+                    first_tweet.setdefault(t["author_id"], t)
+                progress = st.empty()  # first feedback right after the search, before user lookups finish
+                progress.info(f"{len(data)} 件のツイート / {len(first_tweet)} ユーザーを取得中...")
+                with st.spinner("ユーザー情報を取得中..."):
+                    uresp = users_for_tweets(resp, list(first_tweet))
+                progress.empty()
+                if uresp.get("error"):
+                    st.error(f"ユーザー情報取得エラー: {uresp['error']}")
                 else:
-                    user_ids = list({t["author_id"] for t in data})
-                    uresp = call_users_api(user_ids)
-                    if uresp.get("error"):
-                        st.error(f"ユーザー情報取得エラー: {uresp['error']}")
-                    else:
-                        users = uresp.get("data", [])
-                        id_map = {u["id"]: u for u in users}
-                        rows = []
-                        for t in data:
-                            uid = t["author_id"]
-                            u = id_map.get(uid, {})
-                            pm = u.get("public_metrics", {})
-                            rows.append({
-                                "username": "@" + u.get("username", "") if u.get("username") else f"(不明ID:{uid})",
-                                "name": u.get("name",""),
-                                "user_id": uid,
-                                "text": t.get("text","")[:240],
-                                "created_at": t.get("created_at",""),
-                                "followers": pm.get("followers_count"),
-                                "tweet_count": pm.get("tweet_count"),
-                                "following": pm.get("following_count"),
-                                "verified": u.get("verified", False),
-                                "icon": u.get("profile_image_url","")
-                            })
-                        df = pd.DataFrame(rows).drop_duplicates(subset=["user_id"])
-                        def apply_filters(df):
-                            df2 = df
-                            if require_no_posts:
-                                df2 = df2[df2["tweet_count"] == 0]
-                            if require_default_icon:
-                                df2 = df2[df2["icon"].isnull() | df2["icon"].str.contains("default_profile", na=False) | df2["icon"].str.contains("default_profile_images", na=False)]
-                            if min_followers and min_followers > 0:
-                                df2 = df2[df2["followers"].fillna(0) >= min_followers]
-                            if min_following and min_following > 0:
-                                df2 = df2[df2["following"].fillna(0) >= min_following]
-                            if verified_only:
-                                df2 = df2[df2["verified"] == True]
-                            if min_tweet_count and min_tweet_count > 0:
-                                df2 = df2[df2["tweet_count"].fillna(0) >= min_tweet_count]
-                            return df2
-
-                        df_filtered = apply_filters(df)
-                        st.success(f"抽出結果: {len(df_filtered)} 件（全体ヒット {len(df)} 件）")
-                        for idx, r in df_filtered.iterrows():
-                            cols = st.columns([1,6,1])
-                            with cols[0]:
-                                if r["icon"]:
-                                    st.image(r["icon"], width=48)
-                            with cols[1]:
-                                st.markdown(f"**{r['username']}**  {r['name']}  \n{r['text']}")
-                                st.caption(f"followers: {r['followers']} / following: {r['following']} / tweets: {r['tweet_count']} / verified: {r['verified']}")
-                            with cols[2]:
-                                st.write("")
-                                if st.button(f"コピー {r['user_id']}", key=f"copy_{r['user_id']}"):
-                                    st.experimental_set_query_params()
-                                    st.toast("ユーザー名をコピーしました（手動で貼り付け可能）")
-                        csv_bytes = df_filtered.to_csv(index=False).encode("utf-8-sig")
-                        excel_buf = io.BytesIO()
-                        with pd.ExcelWriter(excel_buf, engine="openpyxl") as writer:
-                            df_filtered.to_excel(writer, index=False, sheet_name="results")
-                        excel_bytes = excel_buf.getvalue()
-                        json_bytes = df_filtered.to_json(orient="records", force_ascii=False).encode("utf-8")
-                        cole1, cole2, cole3 = st.columns(3)
-                        with cole1:
-                            st.download_button("CSVダウンロード", data=csv_bytes, file_name="ng_users.csv", mime="text/csv")
-                        with cole2:
-                            st.download_button("Excelダウンロード", data=excel_bytes, file_name="ng_users.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-                        with cole3:
-                            st.download_button("JSONダウンロード", data=json_bytes, file_name="ng_users.json", mime="application/json")
+                    users = uresp.get("data", [])
+                    id_map = {u["id"]: u for u in users}
+                    cols = {"username": [], "name": [], "user_id": [], "text": [], "created_at": [],
+                            "followers": [], "tweet_count": [], "following": [], "verified": [], "icon": []}
+                    for uid, t in first_tweet.items():
+                        u = id_map.get(uid, {})
+                        pm = u.get("public_metrics", {})
+                        cols["username"].append("@" + u.get("username", "") if u.get("username") else f"(不明ID:{uid})")
+                        cols["name"].append(u.get("name",""))
+                        cols["user_id"].append(uid)
+                        cols["text"].append(t.get("text","")[:240])
+                        cols["created_at"].append(t.get("created_at",""))
+                        cols["followers"].append(pm.get("followers_count"))
+                        cols["tweet_count"].append(pm.get("tweet_count"))
+                        cols["following"].append(pm.get("following_count"))
+                        cols["verified"].append(u.get("verified", False))
+                        cols["icon"].append(u.get("profile_image_url",""))
+                    df = pd.DataFrame(cols, copy=False)
+                    def apply_filters(df):
+                        mask = pd.Series(True, index=df.index)
+                        if require_no_posts:
+                            mask &= df["tweet_count"].eq(0)
+                        if require_default_icon:
+                            icon = df["icon"].fillna("")
+                            mask &= icon.eq("") | icon.str.contains("default_profile", regex=False)
+                        if min_followers and min_followers > 0:
+                            mask &= df["followers"].fillna(0).ge(min_followers)
+                        if min_following and min_following > 0:
+                            mask &= df["following"].fillna(0).ge(min_following)
+                        if verified_only:
+                            mask &= df["verified"].eq(True)
+                        if min_tweet_count and min_tweet_count > 0:
+                            mask &= df["tweet_count"].fillna(0).ge(min_tweet_count)
+                        return df.loc[mask]
+
+                    df_filtered = apply_filters(df)
+                    st.success(f"抽出結果: {len(df_filtered)} 件（全体ヒット {len(df)} 件）")
+                    # One grid widget instead of a button per row; cells are selectable/copyable in the grid
+                    st.dataframe(
+                        df_filtered,
+                        column_order=["icon", "username", "name", "text", "followers", "following", "tweet_count", "verified", "user_id", "created_at"],
+                        column_config={
+                            "icon": st.column_config.ImageColumn("icon", width="small"),
+                            "username": st.column_config.TextColumn("username", help="選択して Ctrl+C でコピー"),
+                            "user_id": st.column_config.TextColumn("user_id", help="選択して Ctrl+C でコピー"),
+                            "text": st.column_config.TextColumn("text", width="large"),
+                        },
+                        hide_index=True,
+                        width="stretch",
+                    )
+                    df_export = df_filtered.reset_index(drop=True)
+                    csv_bytes = _to_csv(df_export)
+                    excel_bytes = _to_xlsx(df_export)
+                    json_bytes = _to_json(df_export)
+                    cole1, cole2, cole3 = st.columns(3)
+                    with cole1:
+                        st.download_button("CSVダウンロード", data=csv_bytes, file_name="ng_users.csv", mime="text/csv")
+                    with cole2:
+                        st.download_button("Excelダウンロード", data=excel_bytes, file_name="ng_users.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+                    with cole3:
+                        st.download_button("JSONダウンロード", data=json_bytes, file_name="ng_users.json", mime="application/json")
 
 st.sidebar.header("ダッシュボード")
 hist = db_get_history(10)
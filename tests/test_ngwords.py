@@ -0,0 +1,51 @@
+from ngwords import compile_matcher, count_word_hits, match_words, overlong_words, pack_words, quote_if_space
+
+
+def _joined(chunk):
+    return " OR ".join(quote_if_space(w) for w in chunk)
+
+
+def test_pack_words_respects_max_len():
+    words = ["a" * 100] * 10 + ["b c"]
+    chunks = pack_words(words, max_len=480)
+    assert [w for c in chunks for w in c] == words
+    assert all(len(_joined(c)) <= 480 for c in chunks)
+    assert len(chunks) == 3
+
+
+def test_pack_words_single_chunk():
+    assert pack_words(["spam", "scam"]) == [["spam", "scam"]]
+    assert pack_words([]) == []
+
+
+def test_overlong_words_are_the_ones_pack_words_cannot_fit():
+    words = ["ok", "x" * 481, "b c"]
+    assert overlong_words(words, max_len=480) == ["x" * 481]
+    rest = [w for w in words if w not in overlong_words(words)]
+    assert all(len(_joined(c)) <= 480 for c in pack_words(rest, max_len=480))
+
+
+def test_match_words_credits_shared_prefixes():
+    words = ["scam", "Scammer", "spam", "a.b", "b c"]
+    assert match_words(words, "SCAMMER spAm a.b xb c") == {"scam", "Scammer", "spam", "a.b", "b c"}
+    assert match_words(words, "nothing here") == set()
+    assert match_words([], "scam") == set()
+
+
+def test_match_words_case_folding_without_exact_lower():
+    # IGNORECASE matches these, but .lower() of the matched text differs from the key
+    assert match_words(["s"], "ſ") == {"s"}
+    assert match_words(["σας"], "ΣΑΣ σασ") == {"σας"}
+
+
+def test_compile_matcher_is_cached_per_word_list():
+    assert compile_matcher(("a", "b")) is compile_matcher(("a", "b"))
+
+
+def test_count_word_hits_counts_unique_authors():
+    tweets = [
+        {"author_id": "1", "text": "scam"},
+        {"author_id": "1", "text": "scam spam"},
+        {"author_id": "2", "text": "no"},
+    ]
+    assert count_word_hits(["scam", "spam", "eggs"], tweets) == {"scam": 1, "spam": 1, "eggs": 0}
@@ -0,0 +1,74 @@
+from ratelimit import TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def _bucket(clock, **kwargs):
+    return TokenBucket(1.0, 2, clock=clock, sleep=clock.sleep, **kwargs)
+
+
+def test_burst_then_paced():
+    clock = FakeClock()
+    bucket = _bucket(clock)
+    assert bucket.acquire() and bucket.acquire()
+    assert clock.sleeps == []
+    assert bucket.acquire()
+    assert clock.sleeps == [1.0]
+
+
+def test_reservations_stack_for_concurrent_callers():
+    clock = FakeClock()
+    waits = []  # sleeps that do not advance the clock, as if all callers arrived at once
+    bucket = TokenBucket(1.0, 2, max_wait=10, clock=clock, sleep=waits.append)
+    for _ in range(4):
+        assert bucket.acquire()
+    assert waits == [1.0, 2.0]
+
+
+def test_wait_over_max_wait_is_refused_without_reserving():
+    clock = FakeClock()
+    bucket = _bucket(clock, max_wait=5)
+    for _ in range(6):
+        bucket.on_429()
+    assert bucket.rate == 1.0 / 16
+    assert bucket.acquire() is False
+    assert clock.sleeps == []
+    tokens = bucket.tokens
+    assert bucket.acquire() is False
+    assert bucket.tokens == tokens
+
+
+def test_rate_restored_after_window():
+    clock = FakeClock()
+    bucket = _bucket(clock, restore_after=900)
+    bucket.on_429()
+    bucket.on_429()
+    assert bucket.rate == 0.25
+    clock.now += 899
+    bucket.acquire()
+    assert bucket.rate == 0.25
+    clock.now += 1
+    bucket.acquire()
+    assert bucket.rate == 1.0
+
+
+def test_another_429_extends_the_window():
+    clock = FakeClock()
+    bucket = _bucket(clock, restore_after=900)
+    bucket.on_429()
+    clock.now += 600
+    bucket.on_429()
+    clock.now += 600
+    bucket.acquire()
+    assert bucket.rate == 0.25